@@ -6,11 +6,14 @@ Permite probar la lectura del ultimo correo sin escribir argumentos cada vez.
 
 import os
 import sys
-import subprocess
 
 # Asegurar que src/ esta en el path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
 
-# Ejecutar read_gmail.py en modo --last
-cmd = [sys.executable, "src/gmail/read_gmail.py", "--last"]
-subprocess.run(cmd)
\ No newline at end of file
+from gmail.read_gmail import main as read_main
+
+# Ejecutar read_gmail en modo --last dentro del mismo proceso: se evita
+# pagar el arranque del interprete y los imports de googleapiclient en
+# cada ejecucion (se amortizan si se encadenan varias pruebas)
+sys.argv = ["read_gmail.py", "--last"]
+read_main()